@@ -1,74 +1,202 @@
 from __future__ import annotations
 
+import base64
+import io
 import sqlite3
+from dataclasses import dataclass
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import streamlit as st
 import folium
-from folium.plugins import HeatMap
+from folium.utilities import mercator_transform
+from PIL import Image
 
 DB_PATH = Path("db/housing.db")
 TILES_TABLE = "heatmap_tiles"
 PUBLISHED_TILES = Path("data/published/heatmap_tiles.parquet")
 
+# Same dtypes build_heatmap_tiles.py publishes
+TILE_SCHEMA = pa.schema([
+    ("lat_bin", pa.float32()),
+    ("lon_bin", pa.float32()),
+    ("sales_count", pa.int32()),
+    ("avg_price", pa.float32()),
+    ("median_price", pa.float32()),
+])
+TILE_COLUMNS = TILE_SCHEMA.names
+
+# Tiles field holding each tile column
+TILE_FIELDS = {
+    "lat_bin": "lat",
+    "lon_bin": "lon",
+    "sales_count": "sales",
+    "avg_price": "avg",
+    "median_price": "median",
+}
+
+# Keys build_heatmap_tiles.py stores in the Parquet metadata (tile lat/lon bins, degrees)
+EXTENT_KEYS = ["center_lat", "center_lon", "lat_min", "lat_max", "lon_min", "lon_max"]
+
+# Must match GRID_DEGREES in src/build_heatmap_tiles.py
+GRID_DEGREES = 0.01
+
+# Colour stops sampled from matplotlib's "magma" colormap (dark = low, pale = high)
+MAGMA_STOPS = np.array([
+    [0, 0, 4],
+    [59, 15, 112],
+    [140, 41, 129],
+    [222, 73, 104],
+    [254, 159, 109],
+    [252, 253, 191],
+], dtype=np.float64)
+
 st.set_page_config(page_title="UK Property Heatmap", layout="wide")
 
 st.title("UK Property Heatmap")
 st.caption("Heatmap built from Land Registry Price Paid Data (PPD) aggregated into grid tiles.")
 
 
-@st.cache_data(show_spinner=False)
-def load_tiles() -> pd.DataFrame:
+@dataclass(frozen=True)
+class Tiles:
+    """Heatmap tiles as one contiguous NumPy array per column (struct of arrays)."""
+    lat: np.ndarray     # float32
+    lon: np.ndarray     # float32
+    sales: np.ndarray   # int32
+    avg: np.ndarray     # float32
+    median: np.ndarray  # float32
+    extent: dict[str, float] | None  # EXTENT_KEYS of all tiles; None when there are none
+
+    def __len__(self) -> int:
+        return len(self.lat)
+
+
+# cache_resource hands every session the same read-only arrays; cache_data would pickle
+# them and give each rerun its own copy.
+@st.cache_resource(show_spinner=False)
+def load_tiles() -> Tiles:
     if PUBLISHED_TILES.exists():
-        df = pd.read_parquet(PUBLISHED_TILES)
+        # zstd-compressed, so every column is decoded into fresh heap buffers; the memory map
+        # only spares a copy of the compressed bytes. The real saving is cache_resource above:
+        # this runs once per process and sessions share the result, with no pickled copies.
+        tbl = pq.read_table(pa.memory_map(str(PUBLISHED_TILES), "r"), columns=TILE_COLUMNS)
+        metadata = tbl.schema.metadata or {}
     else:
         conn = sqlite3.connect(str(DB_PATH))
         try:
             df = pd.read_sql_query(
-                f"SELECT lat_bin, lon_bin, sales_count, avg_price, median_price FROM {TILES_TABLE}",
+                f"SELECT {', '.join(TILE_COLUMNS)} FROM {TILES_TABLE}",
                 conn,
             )
         finally:
             conn.close()
+        tbl = pa.Table.from_pandas(df, preserve_index=False)
+        metadata = {}
+
+    # One Arrow cast to the tile dtypes (a no-op for a freshly published Parquet file)
+    tbl = tbl.cast(TILE_SCHEMA, safe=False)
+    tbl = tbl.filter(pc.and_(pc.is_valid(tbl["lat_bin"]), pc.is_valid(tbl["lon_bin"])))
+    # One chunk per column lets to_numpy() hand out views instead of concatenating
+    tbl = tbl.combine_chunks()
+    arrays = {field: tbl[col].to_numpy() for col, field in TILE_FIELDS.items()}
+
+    # Older files (and the SQLite fallback) carry no extent, so work it out once here
+    if all(key.encode() in metadata for key in EXTENT_KEYS):
+        extent = {key: float(metadata[key.encode()]) for key in EXTENT_KEYS}
+    elif tbl.num_rows:
+        lat, lon = arrays["lat"], arrays["lon"]
+        extent = dict(zip(EXTENT_KEYS, map(float, (
+            lat.mean(), lon.mean(), lat.min(), lat.max(), lon.min(), lon.max()
+        ))))
+    else:
+        extent = None
+    return Tiles(**arrays, extent=extent)
 
-    # Basic cleaning
-    for col in ["lat_bin", "lon_bin", "sales_count", "avg_price", "median_price"]:
-        df[col] = pd.to_numeric(df[col], errors="coerce")
-    df = df.dropna(subset=["lat_bin", "lon_bin"]).copy()
-    return df
+
+@st.cache_data(show_spinner=False)
+def build_heat_data(metric: str, min_sales: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Lat, lon and non-negative weight of the tiles with at least min_sales sales."""
+    tiles = load_tiles()
+    mask = tiles.sales >= min_sales
+    # Boolean indexing already yields a fresh array, so clean the weights in place
+    weights = getattr(tiles, TILE_FIELDS[metric])[mask].astype(np.float32, copy=False)
+    np.clip(weights, 0, None, out=weights)
+    np.nan_to_num(weights, copy=False)
+    return tiles.lat[mask], tiles.lon[mask], weights
 
 
-def make_map(df: pd.DataFrame, metric: str, min_sales: int) -> folium.Map:
-    df2 = df[df["sales_count"] >= min_sales].copy()
+def make_map(metric: str, min_sales: int) -> folium.Map:
+    lat, lon, weights = build_heat_data(metric, min_sales)
 
-    if df2.empty:
+    if len(lat) == 0:
         center = (52.4, -2.2)  # Midlands-ish
         m = folium.Map(location=center, zoom_start=7, tiles="CartoDB positron")
         folium.Marker(location=center, tooltip="No data after filters").add_to(m)
         return m
 
-    center = (float(df2["lat_bin"].mean()), float(df2["lon_bin"].mean()))
-    m = folium.Map(location=center, zoom_start=7, tiles="CartoDB positron")
+    lat = lat.astype(np.float64)
+    lon = lon.astype(np.float64)
 
-    # Build heatmap weights
-    if metric == "sales_count":
-        weights = df2["sales_count"].astype(float)
-    else:
-        weights = df2[metric].astype(float).clip(lower=0)
+    # Centre and raster bounds come from the whole tile set (precomputed at build time)
+    extent = load_tiles().extent
+    center = (extent["center_lat"], extent["center_lon"])
+    m = folium.Map(location=center, zoom_start=7, tiles="CartoDB positron")
 
-    heat_data = df2[["lat_bin", "lon_bin"]].assign(w=weights).dropna().values.tolist()
+    # Tiles already sit on a regular grid, so rasterise them straight into a single image
+    # instead of shipping every point to the browser for Leaflet to re-bin.
+    lat_min, lat_max = extent["lat_min"], extent["lat_max"] + GRID_DEGREES
+    lon_min, lon_max = extent["lon_min"], extent["lon_max"] + GRID_DEGREES
+    ny = int(round((lat_max - lat_min) / GRID_DEGREES))
+    nx = int(round((lon_max - lon_min) / GRID_DEGREES))
+
+    # Bin on tile centres so float rounding never pushes a tile over a bin edge
+    H, _, _ = np.histogram2d(
+        lat + GRID_DEGREES / 2,
+        lon + GRID_DEGREES / 2,
+        bins=[ny, nx],
+        range=[[lat_min, lat_max], [lon_min, lon_max]],
+        weights=weights,
+    )
 
-    HeatMap(
-        heat_data,
-        radius=12,
-        blur=16,
-        max_zoom=10,
+    occupied = H > 0
+    levels = np.log1p(H)
+    if occupied.any():
+        lo, hi = levels[occupied].min(), levels[occupied].max()
+        levels = (levels - lo) / (hi - lo) if hi > lo else np.ones_like(levels)
+
+    stops = np.linspace(0, 1, len(MAGMA_STOPS))
+    rgba = np.zeros((ny, nx, 4), dtype=np.uint8)
+    for i in range(3):
+        rgba[..., i] = np.interp(levels, stops, MAGMA_STOPS[:, i])
+    rgba[..., 3] = np.where(occupied, 255, 0)
+
+    # histogram2d rows run south -> north; images run top -> bottom. Then stretch rows
+    # so the degree grid lines up with Leaflet's Web Mercator tiles.
+    rgba = mercator_transform(rgba[::-1], (lat_min, lat_max)).astype(np.uint8)
+
+    buf = io.BytesIO()
+    Image.fromarray(rgba).save(buf, "PNG")
+    png_url = "data:image/png;base64," + base64.b64encode(buf.getvalue()).decode("ascii")
+
+    folium.raster_layers.ImageOverlay(
+        image=png_url,
+        bounds=[[lat_min, lon_min], [lat_max, lon_max]],
+        opacity=0.7,
     ).add_to(m)
 
     return m
 
 
+@st.cache_data(show_spinner=False, max_entries=32)
+def make_map_html(metric: str, min_sales: int) -> str:
+    """Rendered map HTML, cached per control setting so reruns skip folium/Jinja entirely."""
+    return make_map(metric, min_sales)._repr_html_()
+
+
 # Sidebar controls
 with st.sidebar:
     st.header("Controls")
@@ -96,17 +224,16 @@ with st.sidebar:
 
     st.divider()
     st.write("**Tiles loaded:**", f"{len(tiles):,}")
-    st.write("**After filter:**", f"{len(tiles[tiles['sales_count'] >= min_sales]):,}")
-
+    st.write("**After filter:**", f"{np.count_nonzero(tiles.sales >= min_sales):,}")
 
-m = make_map(tiles, metric=metric, min_sales=min_sales)
 
 # Render Folium map
-st.components.v1.html(m._repr_html_(), height=720, scrolling=False)
+st.components.v1.html(make_map_html(metric=metric, min_sales=min_sales), height=720, scrolling=False)
 
 
 with st.expander("Preview heatmap tile data"):
+    top = np.argsort(-tiles.sales, kind="stable")[:200]
     st.dataframe(
-        tiles.sort_values("sales_count", ascending=False).head(200),
+        pd.DataFrame({col: getattr(tiles, field)[top] for col, field in TILE_FIELDS.items()}),
         width="stretch",
     )
\ No newline at end of file
@@ -3,12 +3,18 @@ from __future__ import annotations
 import sqlite3
 from pathlib import Path
 
+import duckdb
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
 DB_PATH = Path("db/housing.db")
 
 # Use region table if it exists, else fall back to UK joined table
 JOINED_REGION = "ppd_sales_geo_region"
 JOINED_UK = "ppd_sales_geo"
 TILES_TABLE = "heatmap_tiles"
+PUBLISHED_TILES = Path("data/published/heatmap_tiles.parquet")
 
 # ~1km-ish grid. 0.01 degrees lat ~= 1.11km. Good enough for a heatmap MVP.
 GRID_DEGREES = 0.01
@@ -22,6 +28,40 @@ def table_exists(conn: sqlite3.Connection, name: str) -> bool:
 def table_rowcount(conn: sqlite3.Connection, name: str) -> int:
     return conn.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
 
+def aggregate_tiles(conn: sqlite3.Connection, source: str) -> pd.DataFrame:
+    """
+    Bin and aggregate sales into grid tiles with DuckDB, which runs the GROUP BY (median
+    included) vectorised and in parallel across cores. The SQLite table is scanned in place
+    through DuckDB's sqlite extension when it can be loaded.
+    """
+    con = duckdb.connect()
+    try:
+        try:
+            con.execute("INSTALL sqlite; LOAD sqlite;")
+            con.execute(f"ATTACH '{DB_PATH.as_posix()}' AS s (TYPE sqlite, READ_ONLY)")
+            relation = f"s.{source}"
+        except duckdb.Error as e:
+            # The extension is downloaded on first use; offline, hand DuckDB the rows instead
+            print(f"DuckDB sqlite extension unavailable ({type(e).__name__}); reading {source} via sqlite3.")
+            sales = pd.read_sql(f"SELECT lat, lon, price FROM {source}", conn)
+            con.register("sales", sales)
+            relation = "sales"
+
+        return con.execute(f"""
+            SELECT
+                floor(lat / {GRID_DEGREES}) * {GRID_DEGREES} AS lat_bin,
+                floor(lon / {GRID_DEGREES}) * {GRID_DEGREES} AS lon_bin,
+                count(*) AS sales_count,
+                avg(price) AS avg_price,
+                median(price) AS median_price
+            FROM {relation}
+            WHERE lat IS NOT NULL AND lon IS NOT NULL AND price IS NOT NULL
+            GROUP BY 1, 2
+            HAVING count(*) >= 5
+        """).df()
+    finally:
+        con.close()
+
 def main() -> None:
     conn = sqlite3.connect(DB_PATH)
     try:
@@ -37,48 +77,41 @@ def main() -> None:
         print(f"{JOINED_UK} rows: {uk_rows:,}")
         print(f"Using source table: {source}")
 
-        conn.execute(f"DROP TABLE IF EXISTS {TILES_TABLE}")
+        tiles = aggregate_tiles(conn, source)
 
-        # median in SQLite: use percentile_cont if available? (often not)
-        # so use median approximation via window functions:
-        conn.execute(f"""
-            CREATE TABLE {TILES_TABLE} AS
-            WITH binned AS (
-                SELECT
-                    CAST(FLOOR(lat / {GRID_DEGREES}) * {GRID_DEGREES} AS REAL) AS lat_bin,
-                    CAST(FLOOR(lon / {GRID_DEGREES}) * {GRID_DEGREES} AS REAL) AS lon_bin,
-                    price
-                FROM {source}
-                WHERE lat IS NOT NULL AND lon IS NOT NULL AND price IS NOT NULL
-            ),
-            ranked AS (
-                SELECT
-                    lat_bin,
-                    lon_bin,
-                    price,
-                    ROW_NUMBER() OVER (PARTITION BY lat_bin, lon_bin ORDER BY price) AS rn,
-                    COUNT(*) OVER (PARTITION BY lat_bin, lon_bin) AS cnt
-                FROM binned
-            )
-            SELECT
-                lat_bin,
-                lon_bin,
-                cnt AS sales_count,
-                AVG(price) AS avg_price,
-                -- median: average of middle values (handles odd/even)
-                AVG(
-                    CASE
-                        WHEN rn IN ((cnt + 1) / 2, (cnt + 2) / 2) THEN price
-                    END
-                ) AS median_price
-            FROM ranked
-            GROUP BY lat_bin, lon_bin, cnt
-            HAVING cnt >= 5
-        """)
+        conn.execute(f"DROP TABLE IF EXISTS {TILES_TABLE}")
+        tiles.to_sql(TILES_TABLE, conn, index=False)
 
         conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TILES_TABLE}_latlon ON {TILES_TABLE}(lat_bin, lon_bin)")
         conn.commit()
 
+        # Publish a typed, compressed copy for the app so it never has to query SQLite
+        PUBLISHED_TILES.parent.mkdir(parents=True, exist_ok=True)
+        published = pa.Table.from_pandas(tiles.astype({
+            "lat_bin": "float32",
+            "lon_bin": "float32",
+            "sales_count": "int32",
+            "avg_price": "float32",
+            "median_price": "float32",
+        }), preserve_index=False)
+
+        # Map centre and bounds only change when tiles are rebuilt, so store them with the
+        # file rather than having the app reduce the columns on every run.
+        if len(tiles):
+            extent = {
+                "center_lat": tiles["lat_bin"].mean(),
+                "center_lon": tiles["lon_bin"].mean(),
+                "lat_min": tiles["lat_bin"].min(),
+                "lat_max": tiles["lat_bin"].max(),
+                "lon_min": tiles["lon_bin"].min(),
+                "lon_max": tiles["lon_bin"].max(),
+            }
+            published = published.replace_schema_metadata({
+                **(published.schema.metadata or {}),
+                **{key: repr(float(value)) for key, value in extent.items()},
+            })
+        pq.write_table(published, PUBLISHED_TILES, compression="zstd", row_group_size=64_000)
+
         n = conn.execute(f"SELECT COUNT(*) FROM {TILES_TABLE}").fetchone()[0]
         if n == 0:
             # Helpful diagnostics
@@ -92,6 +125,7 @@ def main() -> None:
                 print(f"{source} lat/lon range: {latlon}")
         print(f"Built {TILES_TABLE} with {n:,} tiles.")
         print(f"DB: {DB_PATH}")
+        print(f"Published: {PUBLISHED_TILES}")
 
     finally:
         conn.close()
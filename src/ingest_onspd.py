@@ -3,8 +3,14 @@ from __future__ import annotations
 import csv
 import glob
 import sqlite3
+from collections.abc import Iterable, Iterator
 from pathlib import Path
 
+import pandas as pd
+import pyarrow as pa
+
+from postcodes import POSTCODE_RE, morton, normalise_postcodes, pc64
+
 RAW_DIR = Path("data/raw/onspd")
 DB_PATH = Path("db/housing.db")
 
@@ -31,10 +37,6 @@ LAD_NAMES_REGION = {
 }
 
 
-def normalise_postcode(pc: str) -> str:
-    return pc.strip().upper().replace(" ", "")
-
-
 def find_csv_files() -> list[Path]:
     patterns = [str(RAW_DIR / "*.csv"), str(RAW_DIR / "**" / "*.csv")]
     files: list[Path] = []
@@ -44,11 +46,20 @@ def find_csv_files() -> list[Path]:
 
 
 def ensure_schema(conn: sqlite3.Connection) -> None:
+    # Older DBs lack the pc64 key / morton columns; postcode_geo is rebuilt from the CSV anyway
+    cols = [r[1] for r in conn.execute(f"PRAGMA table_info({TABLE_ALL})")]
+    if cols and not {"pc64", "morton"} <= set(cols):
+        print(f"{TABLE_ALL} is missing the pc64/morton columns; dropping it so it can be rebuilt.")
+        conn.execute(f"DROP TABLE {TABLE_ALL}")
+
+    # pc64 (see postcodes.py) is an INTEGER PRIMARY KEY, i.e. the rowid itself
     conn.execute(f"""
                CREATE TABLE IF NOT EXISTS {TABLE_ALL} (
-                   postcode TEXT PRIMARY KEY,
+                   pc64 INTEGER PRIMARY KEY,
+                   postcode TEXT NOT NULL,
                    lat REAL,
                    lon REAL,
+                   morton INTEGER,
                    ladcd TEXT,
                    ladnm TEXT
                )
@@ -58,57 +69,88 @@ def ensure_schema(conn: sqlite3.Connection) -> None:
     conn.commit()
 
 
-def upsert_batch(conn: sqlite3.Connection,
-                 batch: list[tuple[str, float | None, float | None, str | None, str | None]]) -> int:
+PostcodeRow = tuple[int, str, float | None, float | None, int | None, str | None, str | None]
+
+
+def upsert_rows(conn: sqlite3.Connection, rows: Iterable[PostcodeRow]) -> int:
     cur = conn.cursor()
     cur.executemany(
         f"""
-               INSERT INTO {TABLE_ALL} (postcode, lat, lon, ladcd, ladnm)
-               VALUES (?, ?, ?, ?, ?)
-               ON CONFLICT(postcode) DO UPDATE SET
+               INSERT INTO {TABLE_ALL} (pc64, postcode, lat, lon, morton, ladcd, ladnm)
+               VALUES (?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(pc64) DO UPDATE SET
+                 postcode=excluded.postcode,
                  lat=excluded.lat,
                  lon=excluded.lon,
+                 morton=excluded.morton,
                  ladcd=excluded.ladcd,
                  ladnm=excluded.ladnm
                """,
-        batch,
+        rows,
     )
-    conn.commit()
     return cur.rowcount
 
 
-def ingest_csv(conn: sqlite3.Connection, path: Path) -> None:
-    print(f"Ingesting {path} ...")
-    batch: list[tuple[str, float | None, float | None, str | None, str | None]] = []
-    BATCH_SIZE = 50_000
-    total = 0
-
+def read_onspd(path: Path) -> pd.DataFrame:
+    """
+    Load the columns we need from an ONSPD CSV with the pyarrow engine and normalise them
+    with vectorised string kernels. Returns columns: pc64, postcode, lat, lon, morton, ladcd, ladnm.
+    """
     with path.open("r", encoding="utf-8-sig", newline="") as f:
-        reader = csv.DictReader(f)
+        header = next(csv.reader(f), [])
+
+    pc_col = "pcds" if "pcds" in header else "pcd"
+    lon_col = "long" if "long" in header else "lon"
+    text_cols = [c for c in (pc_col, "ladcd", "ladnm") if c in header]
+    usecols = text_cols + [c for c in ("lat", lon_col) if c in header]
+
+    df = pd.read_csv(
+        path,
+        usecols=usecols,
+        dtype={c: "string[pyarrow]" for c in text_cols} | {c: "float64" for c in ("lat", lon_col)},
+        encoding="utf-8-sig",
+        engine="pyarrow",
+    )
+    df = df.rename(columns={pc_col: "postcode", lon_col: "lon"})
+    df = df.reindex(columns=["postcode", "lat", "lon", "ladcd", "ladnm"])
+
+    df["postcode"] = pd.arrays.ArrowStringArray(normalise_postcodes(pa.array(df["postcode"].array)))
+    for col in ("ladcd", "ladnm"):
+        df[col] = df[col].astype("string[pyarrow]").str.strip().replace("", pd.NA)
 
-        for i, row in enumerate(reader, start=1):
-            pc_raw = row.get("pcds") or row.get("pcd") or ""
-            if not pc_raw:
-                continue
-            pc = normalise_postcode(pc_raw)
+    df = df[df["postcode"].str.match(POSTCODE_RE, na=False)]
+    df.insert(0, "pc64", pc64(pa.array(df["postcode"].array)))
+
+    # Z-order cell per postcode, used to cluster the joined sales tables (see ingest_ppd.py)
+    has_coords = df["lat"].notna() & df["lon"].notna()
+    df.insert(4, "morton", pd.Series(pd.NA, index=df.index, dtype="Int64"))
+    df.loc[has_coords, "morton"] = morton(
+        df.loc[has_coords, "lat"].to_numpy(), df.loc[has_coords, "lon"].to_numpy()
+    )
+    return df
 
-            lat_s = (row.get("lat") or "").strip()
-            lon_s = (row.get("long") or row.get("lon") or "").strip()
-            lat = float(lat_s) if lat_s else None
-            lon = float(lon_s) if lon_s else None
 
-            ladcd = (row.get("ladcd") or "").strip() or None
-            ladnm = (row.get("ladnm") or "").strip() or None
+def iter_rows(df: pd.DataFrame) -> Iterator[PostcodeRow]:
+    """
+    Yield DB-ready tuples (NA -> None), converting 100k rows at a time so only one chunk of
+    Python objects is alive while sqlite3 consumes the rows.
+    """
+    CHUNK_ROWS = 100_000
+    for start in range(0, len(df), CHUNK_ROWS):
+        chunk = df.iloc[start:start + CHUNK_ROWS]
+        chunk = chunk.astype(object).where(chunk.notna(), None)
+        yield from chunk.itertuples(index=False, name=None)
+        print(f"  processed ~{start + len(chunk):,} rows...")
 
-            batch.append((pc, lat, lon, ladcd, ladnm))
 
-            if len(batch) >= BATCH_SIZE:
-                total += upsert_batch(conn, batch)
-                print(f"  processed ~{i:,} rows...")
-                batch.clear()
+def ingest_csv(conn: sqlite3.Connection, path: Path) -> None:
+    print(f"Ingesting {path} ...")
+    df = read_onspd(path)
 
-        if batch:
-            total += upsert_batch(conn, batch)
+    # One executemany over a generator, in one transaction: no per-batch lists or commits
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        total = upsert_rows(conn, iter_rows(df))
 
     print(f"Done ingesting. Upserted approx {total:,} rows.")
 
@@ -116,20 +158,29 @@ def ingest_csv(conn: sqlite3.Connection, path: Path) -> None:
 def build_region(conn: sqlite3.Connection) -> None:
     print("Building region subset table ...")
     conn.execute(f"DROP TABLE IF EXISTS {TABLE_REGION}")
-    placeholders = ",".join(["?"] * len(LAD_NAMES_REGION))
+
+    # Drive the join from a small LAD table so SQLite probes idx_postcode_geo_ladnm once per LAD.
+    # CROSS JOIN pins that order: region_lads has no statistics, and left to itself the planner
+    # scans postcode_geo and probes region_lads once per row instead.
+    conn.execute("DROP TABLE IF EXISTS temp.region_lads")
+    conn.execute("CREATE TEMP TABLE region_lads(ladnm TEXT PRIMARY KEY)")
+    conn.executemany("INSERT INTO region_lads VALUES (?)", [(n,) for n in sorted(LAD_NAMES_REGION)])
+
     conn.execute(
         f"""
                CREATE TABLE {TABLE_REGION} AS
-               SELECT *
-               FROM {TABLE_ALL}
-               WHERE ladnm IN ({placeholders})
-                 AND lat IS NOT NULL
-                 AND lon IS NOT NULL
-               """,
-        tuple(sorted(LAD_NAMES_REGION)),
+               SELECT g.*
+               FROM region_lads r
+               CROSS JOIN {TABLE_ALL} g
+                 ON g.ladnm = r.ladnm
+               WHERE g.lat IS NOT NULL
+                 AND g.lon IS NOT NULL
+               """
     )
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE_REGION}_pc64 ON {TABLE_REGION}(pc64)")
     conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE_REGION}_ladnm ON {TABLE_REGION}(ladnm)")
     conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE_REGION}_latlon ON {TABLE_REGION}(lat, lon)")
+    conn.execute("DROP TABLE region_lads")
     conn.commit()
     print("Region table built.")
 
@@ -145,9 +196,14 @@ def main() -> None:
     DB_PATH.parent.mkdir(parents=True, exist_ok=True)
     conn = sqlite3.connect(DB_PATH)
     try:
+        # This script creates housing.db, so the page size is set here. It only takes effect on
+        # a fresh file and has to come before journal_mode (WAL pins it from then on).
+        conn.execute("PRAGMA page_size = 8192;")
         conn.execute("PRAGMA journal_mode = WAL;")
         conn.execute("PRAGMA synchronous = NORMAL;")
         conn.execute("PRAGMA temp_store = MEMORY;")
+        conn.execute("PRAGMA cache_size = -524288;")  # 512 MiB
+        conn.execute("PRAGMA wal_autocheckpoint = 100000;")
         ensure_schema(conn)
 
         chosen = None
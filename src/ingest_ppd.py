@@ -2,28 +2,147 @@ from __future__ import annotations
 
 import csv
 import sqlite3
+from collections import deque
+from collections.abc import Iterator
 from pathlib import Path
 
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pac
+
+from postcodes import POSTCODE_RE, normalise_postcodes, pc64
+
 PPD_CSV = Path("data/raw/ppd/pp-2025.csv")
 PPD_CSV_ALT = Path("Data/raw/ppd/pp-2025.csv")  # in case the folder was created with a capital D
 DB_PATH = Path("db/housing.db")
 
 TABLE_PPD = "ppd_sales"
+TABLE_STAGE = "ppd_stage"
 TABLE_JOINED_UK = "ppd_sales_geo"
 TABLE_JOINED_REGION = "ppd_sales_geo_region"
+TABLE_JOINED_RTREE = "ppd_sales_geo_rt"
+
+# PPD format (16 cols, headerless in the usual download). Names match the ppd_sales columns.
+PPD_COLUMNS = [
+    "transaction_id",     # {GUID}
+    "price",
+    "transfer_date",      # YYYY-MM-DD 00:00
+    "postcode",
+    "property_type",      # D/S/T/F/O
+    "new_build",          # old/new (Y/N)
+    "tenure",             # F/L
+    "paon",
+    "saon",
+    "street",
+    "locality",
+    "town",               # town_city
+    "district",
+    "county",
+    "ppd_category_type",  # A/B
+    "record_status",      # A/D
+]
+# Rows with at least the columns up to tenure are loaded; missing address fields become NULL
+PPD_MIN_COLUMNS = 7
+# Whole pounds only; anything else (e.g. "12,5") drops the row. 18 digits always fits int64.
+PRICE_RE = r"^[0-9]{1,18}$"
+
+
+def strip_or_null(col: pa.Array | pa.ChunkedArray) -> pa.Array | pa.ChunkedArray:
+    """Trim whitespace and turn empty strings into nulls."""
+    col = pc.utf8_trim_whitespace(col)
+    return pc.if_else(pc.equal(col, ""), pa.scalar(None, pa.string()), col)
+
+
+def clean_ppd(batch: pa.RecordBatch) -> pa.Table:
+    """
+    Trim fields, normalise postcodes, drop rows without a transaction id, numeric price or
+    usable postcode, and add the pc64 join key. Columns come back as PPD_COLUMNS + pc64.
+    """
+    columns = {name: strip_or_null(batch[name]) for name in PPD_COLUMNS}
+    columns["transfer_date"] = pc.fill_null(columns["transfer_date"], "")
+    columns["postcode"] = normalise_postcodes(columns["postcode"])
+
+    table = pa.table({name: columns[name] for name in PPD_COLUMNS})
+    table = table.filter(pc.and_(
+        pc.and_(pc.is_valid(table["transaction_id"]), pc.match_substring_regex(table["price"], PRICE_RE)),
+        pc.match_substring_regex(table["postcode"], POSTCODE_RE),
+    ))
+    table = table.set_column(PPD_COLUMNS.index("price"), "price", pc.cast(table["price"], pa.int64()))
+    return table.append_column("pc64", pa.array(pc64(table["postcode"]), type=pa.int64()))
 
 
-def normalise_postcode(pc: str) -> str:
-    return pc.strip().upper().replace(" ", "")
+def pad_rows(texts: list[str]) -> pa.RecordBatch:
+    """Parse rows the Arrow reader rejected for their column count, padded or cut to PPD_COLUMNS."""
+    width = len(PPD_COLUMNS)
+    rows = [(row + [""] * width)[:width] for row in csv.reader(texts)]
+    return pa.RecordBatch.from_arrays(
+        [pa.array(col, type=pa.string()) for col in zip(*rows)], names=PPD_COLUMNS
+    )
+
+
+def iter_batches(reader: pac.CSVStreamingReader, rejected: deque[str]) -> Iterator[pa.RecordBatch]:
+    """
+    Yield the reader's batches, each followed by whatever ragged rows its invalid_row_handler
+    has put in `rejected` so far. The handler runs as the reader parses ahead, so rejected rows
+    are drained here rather than collected for the whole file.
+    """
+    for batch in reader:
+        yield batch
+        if rejected:
+            yield pad_rows([rejected.popleft() for _ in range(len(rejected))])
+    if rejected:
+        yield pad_rows(list(rejected))
+
+
+def add_pc64_column(conn: sqlite3.Connection) -> None:
+    """
+    Give a ppd_sales from before the pc64 key that column, backfilled from its postcodes.
+    The table may hold sales from earlier PPD files, so it is migrated in place, not rebuilt.
+    Postcodes that fail POSTCODE_RE get a NULL key and simply don't join.
+    """
+    BACKFILL_ROWS = 200_000
+    backfilled = 0
+
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        # ALTER TABLE can't add a NOT NULL column without a default, so pc64 stays nullable here
+        conn.execute(f"ALTER TABLE {TABLE_PPD} ADD COLUMN pc64 INTEGER")
+        last_rowid = 0
+        while True:
+            rows = conn.execute(
+                f"SELECT rowid, postcode FROM {TABLE_PPD} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last_rowid, BACKFILL_ROWS),
+            ).fetchall()
+            if not rows:
+                break
+            rowids, postcodes = zip(*rows)
+            postcodes = normalise_postcodes(pa.array(postcodes, type=pa.string()))
+            valid = pc.match_substring_regex(postcodes, POSTCODE_RE).to_pylist()
+            keys = pc64(postcodes).tolist()
+            conn.executemany(
+                f"UPDATE {TABLE_PPD} SET pc64 = ? WHERE rowid = ?",
+                ((key if ok else None, rowid) for key, ok, rowid in zip(keys, valid, rowids)),
+            )
+            backfilled += len(rows)
+            last_rowid = rowids[-1]
+
+    print(f"Added pc64 to {TABLE_PPD} and backfilled {backfilled:,} rows.")
 
 
 def ensure_schema(conn: sqlite3.Connection) -> None:
+    # Older DBs have no pc64 join key; add it rather than lose sales loaded from other files
+    cols = [r[1] for r in conn.execute(f"PRAGMA table_info({TABLE_PPD})")]
+    if cols and "pc64" not in cols:
+        print(f"{TABLE_PPD} has no pc64 key column; adding it.")
+        add_pc64_column(conn)
+
     conn.execute(f"""
         CREATE TABLE IF NOT EXISTS {TABLE_PPD} (
             transaction_id TEXT PRIMARY KEY,
             price INTEGER NOT NULL,
             transfer_date TEXT NOT NULL,
             postcode TEXT NOT NULL,
+            pc64 INTEGER NOT NULL,
             property_type TEXT,
             new_build TEXT,
             tenure TEXT,
@@ -38,11 +157,20 @@ def ensure_schema(conn: sqlite3.Connection) -> None:
             record_status TEXT
         )
     """)
-    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE_PPD}_postcode ON {TABLE_PPD}(postcode)")
-    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE_PPD}_date ON {TABLE_PPD}(transfer_date)")
+    ensure_indexes(conn)
     conn.commit()
 
 
+def ensure_indexes(conn: sqlite3.Connection) -> None:
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE_PPD}_pc64 ON {TABLE_PPD}(pc64)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE_PPD}_date ON {TABLE_PPD}(transfer_date)")
+
+
+def drop_indexes(conn: sqlite3.Connection) -> None:
+    conn.execute(f"DROP INDEX IF EXISTS idx_{TABLE_PPD}_pc64")
+    conn.execute(f"DROP INDEX IF EXISTS idx_{TABLE_PPD}_date")
+
+
 def detect_header(first_row: list[str]) -> bool:
     """
     PPD downloads are usually headerless. If first row contains non-date/non-numeric fields,
@@ -74,121 +202,73 @@ def ingest_ppd(conn: sqlite3.Connection) -> None:
 
     print(f"Ingesting PPD from: {ppd_path}")
 
-    BATCH_SIZE = 50_000
-    batch = []
+    # ~6k PPD rows per parsed batch. The reader parses ahead on a background thread and can
+    # queue up to 32 blocks, so the block size also caps how much of the file sits in memory.
+    BLOCK_BYTES = 1 << 20
     total_rows_read = 0
     total_rows_written = 0
 
+    # Bulk load: stage rows in an unindexed table, then merge into ppd_sales in one go with its
+    # secondary indexes dropped, and rebuild them once at the end. The stage lives in the main
+    # DB file rather than TEMP, which temp_store=MEMORY would keep entirely in RAM.
+    conn.execute(f"DROP TABLE IF EXISTS {TABLE_STAGE}")
+    conn.execute(f"CREATE TABLE {TABLE_STAGE} AS SELECT * FROM {TABLE_PPD} LIMIT 0")
+    stage_columns = PPD_COLUMNS + ["pc64"]
     insert_sql = f"""
-        INSERT INTO {TABLE_PPD} (
-            transaction_id, price, transfer_date, postcode, property_type, new_build, tenure,
-            paon, saon, street, locality, town, district, county,
-            ppd_category_type, record_status
-        )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ON CONFLICT(transaction_id) DO UPDATE SET
-            price=excluded.price,
-            transfer_date=excluded.transfer_date,
-            postcode=excluded.postcode,
-            property_type=excluded.property_type,
-            new_build=excluded.new_build,
-            tenure=excluded.tenure,
-            paon=excluded.paon,
-            saon=excluded.saon,
-            street=excluded.street,
-            locality=excluded.locality,
-            town=excluded.town,
-            district=excluded.district,
-            county=excluded.county,
-            ppd_category_type=excluded.ppd_category_type,
-            record_status=excluded.record_status
+        INSERT INTO {TABLE_STAGE} ({", ".join(stage_columns)})
+        VALUES ({", ".join(["?"] * len(stage_columns))})
     """
 
+    # Peek at first row to see if it's a header
     with ppd_path.open("r", encoding="utf-8-sig", newline="") as f:
-        reader = csv.reader(f)
-
-        # Peek at first row to see if it's a header
         try:
-            first_row = next(reader)
+            first_row = next(csv.reader(f))
         except StopIteration:
             raise SystemExit(f"{ppd_path} is empty")
 
-        has_header = detect_header(first_row)
-        if has_header:
-            print("Detected header row in PPD CSV; skipping it.")
-        else:
-            # Process the first row as data
-            reader = iter([first_row] + list(reader))
-
-        for row in reader:
-            total_rows_read += 1
-
-            # PPD format (typically 16 cols):
-            #  0 transaction_id
-            #  1 price
-            #  2 transfer_date (YYYY-MM-DD)
-            #  3 postcode
-            #  4 property_type (D/S/T/F/O)
-            #  5 old/new (Y/N)
-            #  6 tenure (F/L)
-            #  7 PAON
-            #  8 SAON
-            #  9 street
-            # 10 locality
-            # 11 town_city
-            # 12 district
-            # 13 county
-            # 14 ppd_category_type (A/B)
-            # 15 record_status (A/D)
-            if not row or len(row) < 7:
-                continue
-
-            txid = (row[0] or "").strip()
-            if not txid:
-                continue
-
-            try:
-                price = int((row[1] or "").strip())
-            except Exception:
-                continue
-
-            transfer_date = (row[2] or "").strip()
-            postcode = normalise_postcode(row[3] or "")
-            if not postcode:
-                continue
-
-            property_type = (row[4] or "").strip() or None
-            new_build = (row[5] or "").strip() or None
-            tenure = (row[6] or "").strip() or None
-
-            # Optional address-ish fields (may or may not exist in your download)
-            paon = (row[7] or "").strip() if len(row) > 7 else ""
-            saon = (row[8] or "").strip() if len(row) > 8 else ""
-            street = (row[9] or "").strip() if len(row) > 9 else ""
-            locality = (row[10] or "").strip() if len(row) > 10 else ""
-            town = (row[11] or "").strip() if len(row) > 11 else ""
-            district = (row[12] or "").strip() if len(row) > 12 else ""
-            county = (row[13] or "").strip() if len(row) > 13 else ""
-            ppd_category_type = (row[14] or "").strip() if len(row) > 14 else ""
-            record_status = (row[15] or "").strip() if len(row) > 15 else ""
-
-            batch.append((
-                txid, price, transfer_date, postcode, property_type, new_build, tenure,
-                paon or None, saon or None, street or None, locality or None, town or None,
-                district or None, county or None, ppd_category_type or None, record_status or None
-            ))
-
-            if len(batch) >= BATCH_SIZE:
-                conn.executemany(insert_sql, batch)
-                conn.commit()
-                total_rows_written += len(batch)
-                print(f"  processed ~{total_rows_read:,} rows (written ~{total_rows_written:,})")
-                batch.clear()
-
-        if batch:
-            conn.executemany(insert_sql, batch)
-            conn.commit()
-            total_rows_written += len(batch)
+    has_header = detect_header(first_row)
+    if has_header:
+        print("Detected header row in PPD CSV; skipping it.")
+
+    # Arrow only accepts rows with exactly 16 columns. Shorter/longer rows are handed back
+    # to Python and padded, as the old csv.reader loop did, unless they stop before tenure.
+    rejected: deque[str] = deque()
+
+    def keep_ragged_row(row: pac.InvalidRow) -> str:
+        if row.actual_columns >= PPD_MIN_COLUMNS:
+            rejected.append(row.text)
+        return "skip"
+
+    # Stream the file through Arrow's C CSV reader one block at a time, so Python only ever
+    # holds one parsed block. Everything is read as text and cleaned in clean_ppd.
+    reader = pac.open_csv(
+        ppd_path,
+        read_options=pac.ReadOptions(
+            column_names=PPD_COLUMNS,
+            skip_rows=1 if has_header else 0,
+            block_size=BLOCK_BYTES,
+        ),
+        parse_options=pac.ParseOptions(invalid_row_handler=keep_ragged_row),
+        convert_options=pac.ConvertOptions(
+            column_types={name: pa.string() for name in PPD_COLUMNS},
+            strings_can_be_null=True,
+        ),
+    )
+
+    with conn:
+        for batch in iter_batches(reader, rejected):
+            total_rows_read += batch.num_rows
+            table = clean_ppd(batch)
+            conn.executemany(insert_sql, zip(*(col.to_pylist() for col in table.columns)))
+            total_rows_written += table.num_rows
+            print(f"  staged ~{total_rows_written:,} rows (read ~{total_rows_read:,})")
+
+        print(f"Merging {TABLE_STAGE} into {TABLE_PPD} ...")
+        drop_indexes(conn)
+        conn.execute(f"INSERT OR REPLACE INTO {TABLE_PPD} SELECT * FROM {TABLE_STAGE}")
+        ensure_indexes(conn)
+
+    conn.execute(f"DROP TABLE {TABLE_STAGE}")
 
     print(f"Done. Read ~{total_rows_read:,} rows; wrote ~{total_rows_written:,} rows into {TABLE_PPD}.")
 
@@ -196,6 +276,9 @@ def ingest_ppd(conn: sqlite3.Connection) -> None:
 def build_joined_tables(conn: sqlite3.Connection) -> None:
     print("Building joined table (PPD + postcode_geo)...")
 
+    # Rows are inserted in Morton order (precomputed per postcode in postcode_geo), so sales in
+    # the same map tile end up on neighbouring pages instead of scattered by transaction_id.
+
     conn.execute(f"DROP TABLE IF EXISTS {TABLE_JOINED_UK}")
     conn.execute(f"""
         CREATE TABLE {TABLE_JOINED_UK} AS
@@ -209,11 +292,13 @@ def build_joined_tables(conn: sqlite3.Connection) -> None:
             p.tenure,
             g.lat,
             g.lon,
-            g.ladnm
+            g.ladnm,
+            g.morton
         FROM {TABLE_PPD} p
         JOIN postcode_geo g
-          ON p.postcode = g.postcode
+          ON p.pc64 = g.pc64
         WHERE g.lat IS NOT NULL AND g.lon IS NOT NULL
+        ORDER BY morton
     """)
     conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE_JOINED_UK}_latlon ON {TABLE_JOINED_UK}(lat, lon)")
     conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE_JOINED_UK}_date ON {TABLE_JOINED_UK}(transfer_date)")
@@ -239,17 +324,46 @@ def build_joined_tables(conn: sqlite3.Connection) -> None:
                 p.tenure,
                 g.lat,
                 g.lon,
-                g.ladnm
+                g.ladnm,
+                g.morton
             FROM {TABLE_PPD} p
             JOIN postcode_geo_region g
-              ON p.postcode = g.postcode
+              ON p.pc64 = g.pc64
             WHERE g.lat IS NOT NULL AND g.lon IS NOT NULL
+            ORDER BY morton
         """)
         conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE_JOINED_REGION}_latlon ON {TABLE_JOINED_REGION}(lat, lon)")
         conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE_JOINED_REGION}_date ON {TABLE_JOINED_REGION}(transfer_date)")
         conn.commit()
 
 
+def build_rtree(conn: sqlite3.Connection) -> None:
+    """
+    Spatial index over ppd_sales_geo so viewport (bbox) queries don't scan every sale.
+    id is the ppd_sales_geo rowid, and price is an auxiliary column stored in the R-tree
+    leaves, so a bbox query can aggregate prices without joining back:
+
+        SELECT price FROM ppd_sales_geo_rt
+        WHERE minLat >= ? AND maxLat <= ? AND minLon >= ? AND maxLon <= ?
+    """
+    print(f"Building R-tree index {TABLE_JOINED_RTREE} ...")
+    with conn:
+        conn.execute(f"DROP TABLE IF EXISTS {TABLE_JOINED_RTREE}")
+        conn.execute(f"""
+            CREATE VIRTUAL TABLE {TABLE_JOINED_RTREE} USING rtree(
+                id,
+                minLat, maxLat,
+                minLon, maxLon,
+                +price INTEGER
+            )
+        """)
+        conn.execute(f"""
+            INSERT INTO {TABLE_JOINED_RTREE} (id, minLat, maxLat, minLon, maxLon, price)
+            SELECT rowid, lat, lat, lon, lon, price
+            FROM {TABLE_JOINED_UK}
+        """)
+
+
 def main() -> None:
     DB_PATH.parent.mkdir(parents=True, exist_ok=True)
 
@@ -258,18 +372,21 @@ def main() -> None:
         conn.execute("PRAGMA journal_mode=WAL;")
         conn.execute("PRAGMA synchronous=NORMAL;")
         conn.execute("PRAGMA temp_store=MEMORY;")
+        conn.execute("PRAGMA cache_size=-262144;")  # 256 MiB
+        conn.execute("PRAGMA mmap_size=30000000000;")
+
+        # sanity check: postcode_geo must exist with the join keys, before ppd_sales is touched
+        geo_cols = {r[1] for r in conn.execute("PRAGMA table_info(postcode_geo)")}
+        if not geo_cols:
+            raise SystemExit("Missing table postcode_geo. Run python src/ingest_onspd.py first.")
+        if not {"pc64", "morton"} <= geo_cols:
+            raise SystemExit("postcode_geo predates the pc64/morton schema; re-run python src/ingest_onspd.py first.")
 
         ensure_schema(conn)
         ingest_ppd(conn)
 
-        # sanity check: postcode_geo must exist
-        has_geo = conn.execute("""
-            SELECT 1 FROM sqlite_master WHERE type='table' AND name='postcode_geo'
-        """).fetchone()
-        if not has_geo:
-            raise SystemExit("Missing table postcode_geo. Run python src/ingest_onspd.py first.")
-
         build_joined_tables(conn)
+        build_rtree(conn)
 
         ppd_count = conn.execute(f"SELECT COUNT(*) FROM {TABLE_PPD}").fetchone()[0]
         joined_count = conn.execute(f"SELECT COUNT(*) FROM {TABLE_JOINED_UK}").fetchone()[0]
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Normalised postcodes (upper case, no spaces) we are willing to key, e.g. "B11AA" .. "SW1A1AA"
+POSTCODE_RE = r"^[A-Z0-9]{2,7}$"
+
+# Each char is packed into 6 bits as ord(c) - 31, which keeps '0'-'9' and 'A'-'Z' in 1..63
+# and leaves 0 for "no char", so a postcode of <= 7 chars maps to a unique 42-bit integer.
+PC64_MAX_LEN = 7
+PC64_BITS = 6
+PC64_BLOCK_ROWS = 1 << 20
+
+# Same grid as GRID_DEGREES in build_heatmap_tiles.py, so each heatmap tile is one Morton cell
+MORTON_GRID_DEGREES = 0.01
+
+
+def normalise_postcodes(col: pa.Array | pa.ChunkedArray) -> pa.Array | pa.ChunkedArray:
+    """Upper-case postcodes and drop every space, using byte-wise (ASCII) Arrow kernels."""
+    return pc.replace_substring(pc.ascii_upper(col), " ", "")
+
+
+def pc64(postcodes: pa.Array | pa.ChunkedArray) -> np.ndarray:
+    """
+    Pack normalised postcodes into int64 join keys. Callers must filter with POSTCODE_RE first;
+    anything longer than PC64_MAX_LEN chars would be truncated.
+
+    Bytes are gathered straight from the Arrow offset/data buffers into an (n, 7) matrix, so no
+    Python str is created per postcode. Works in blocks to bound the size of that matrix.
+    """
+    chunks = postcodes.chunks if isinstance(postcodes, pa.ChunkedArray) else [postcodes]
+    blocks = [
+        pack_pc64(chunk.slice(start, PC64_BLOCK_ROWS))
+        for chunk in chunks
+        for start in range(0, len(chunk), PC64_BLOCK_ROWS)
+    ]
+    return np.concatenate(blocks) if blocks else np.empty(0, dtype=np.int64)
+
+
+def pack_pc64(arr: pa.Array) -> np.ndarray:
+    offset_type = np.int64 if pa.types.is_large_string(arr.type) else np.int32
+    _, offsets_buf, data_buf = arr.buffers()
+    offsets = np.frombuffer(offsets_buf, dtype=offset_type)[arr.offset:arr.offset + len(arr) + 1]
+    data = np.frombuffer(data_buf, dtype=np.uint8) if data_buf is not None else np.empty(0, np.uint8)
+    if data.size == 0:
+        data = np.zeros(1, dtype=np.uint8)
+
+    pos = np.arange(PC64_MAX_LEN)
+    in_string = pos < np.diff(offsets)[:, None]
+    idx = np.where(in_string, offsets[:-1, None] + pos, 0)
+    codes = np.where(in_string, data[idx].astype(np.int64) - 31, 0)
+    shifts = PC64_BITS * np.arange(PC64_MAX_LEN, dtype=np.int64)
+    return (codes << shifts).sum(axis=1)
+
+
+def spread_bits16(x: np.ndarray) -> np.ndarray:
+    """Spread the low 16 bits of each x out to the even bit positions of a 32-bit int."""
+    x = x.astype(np.uint32) & 0xFFFF
+    x = (x | (x << 8)) & 0x00FF00FF
+    x = (x | (x << 4)) & 0x0F0F0F0F
+    x = (x | (x << 2)) & 0x33333333
+    x = (x | (x << 1)) & 0x55555555
+    return x
+
+
+def morton(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """
+    Z-order code of the grid cell containing each (lat, lon); nearby cells get nearby codes.
+    Coordinates must not be NaN.
+    """
+    y = spread_bits16(np.floor((np.asarray(lat) + 90) / MORTON_GRID_DEGREES))
+    x = spread_bits16(np.floor((np.asarray(lon) + 180) / MORTON_GRID_DEGREES))
+    return ((y << 1) | x).astype(np.int64)
\ No newline at end of file
@@ -1,20 +1,35 @@
+from __future__ import annotations
+
 import sqlite3
+from pathlib import Path
+
+DB_PATH = Path("db/housing.db")
+
+
+def main() -> None:
+    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        cur = conn.cursor()
 
-conn = sqlite3.connect("db/housing.db")
-cur = conn.cursor()
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS test (
+            id INTEGER PRIMARY KEY,
+            name TEXT
+        )
+        """)
 
-cur.execute("""
-CREATE TABLE IF NOT EXISTS test (
-    id INTEGER PRIMARY KEY,
-    name TEXT
-)
-""")
+        # Keep a single smoke-test row rather than adding one on every run
+        cur.execute("DELETE FROM test")
+        cur.execute("INSERT INTO test (name) VALUES (?)", ("Keith",))
 
-cur.execute("INSERT INTO test (name) VALUES ('Keith')")
+        conn.commit()
 
-conn.commit()
+        for row in cur.execute("SELECT * FROM test"):
+            print(row)
+    finally:
+        conn.close()
 
-for row in cur.execute("SELECT * FROM test"):
-    print(row)
 
-conn.close()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file